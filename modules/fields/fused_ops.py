@@ -0,0 +1,198 @@
+"""
+Fused kernels for the hot elementwise ops of the NGP fields.
+
+Every op here has a plain PyTorch reference implementation in ngp_nerf.py;
+the kernels are only used when no gradient is required and Triton (GPU
+inputs) or Numba (CPU inputs) is importable.
+"""
+
+import numpy as np
+import torch
+
+try:
+    import triton
+    import triton.language as tl
+    HAS_TRITON = True
+except ImportError:
+    HAS_TRITON = False
+
+try:
+    import numba
+    HAS_NUMBA = True
+except ImportError:
+    HAS_NUMBA = False
+
+
+_BLOCK = 1024
+
+
+def can_fuse(x: torch.Tensor):
+    return HAS_TRITON and x.is_cuda and not (torch.is_grad_enabled() and x.requires_grad)
+
+
+def can_fuse_cpu(x: torch.Tensor):
+    return HAS_NUMBA and not x.is_cuda and not (torch.is_grad_enabled() and x.requires_grad)
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _contract_kernel(x_ptr, aabb_ptr, out_ptr, n_rows, eps,
+                         DERIVATIVE: tl.constexpr, BLOCK: tl.constexpr):
+        rows = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        valid = rows < n_rows
+        offs = rows * 3
+
+        x0 = tl.load(x_ptr + offs + 0, mask=valid, other=0.).to(tl.float32)
+        x1 = tl.load(x_ptr + offs + 1, mask=valid, other=0.).to(tl.float32)
+        x2 = tl.load(x_ptr + offs + 2, mask=valid, other=0.).to(tl.float32)
+        min0 = tl.load(aabb_ptr + 0).to(tl.float32)
+        min1 = tl.load(aabb_ptr + 1).to(tl.float32)
+        min2 = tl.load(aabb_ptr + 2).to(tl.float32)
+        max0 = tl.load(aabb_ptr + 3).to(tl.float32)
+        max1 = tl.load(aabb_ptr + 4).to(tl.float32)
+        max2 = tl.load(aabb_ptr + 5).to(tl.float32)
+
+        # aabb is at [-1, 1]
+        x0 = (x0 - min0) / (max0 - min0) * 2. - 1.
+        x1 = (x1 - min1) / (max1 - min1) * 2. - 1.
+        x2 = (x2 - min2) / (max2 - min2) * 2. - 1.
+        # inv_mag == 1 inside the unit ball, where both outputs are the identity.
+        # 1 / sqrt rather than tl.math.rsqrt, which Triton 2.0 does not have.
+        inv_mag = 1. / tl.sqrt(tl.maximum(x0 * x0 + x1 * x1 + x2 * x2, 1.))
+        s = (2. - inv_mag) * inv_mag
+
+        if DERIVATIVE:
+            b = 2. * (inv_mag - 1.) * inv_mag * inv_mag * inv_mag
+            y0 = tl.maximum(s + x0 * x0 * b, eps)
+            y1 = tl.maximum(s + x1 * x1 * b, eps)
+            y2 = tl.maximum(s + x2 * x2 * b, eps)
+        else:
+            # [-inf, inf] is at [0, 1]
+            y0 = x0 * s / 4. + .5
+            y1 = x1 * s / 4. + .5
+            y2 = x2 * s / 4. + .5
+
+        tl.store(out_ptr + offs + 0, y0, mask=valid)
+        tl.store(out_ptr + offs + 1, y1, mask=valid)
+        tl.store(out_ptr + offs + 2, y2, mask=valid)
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _masked_exp_kernel(x_ptr, mask_ptr, out_ptr, n, shift, BLOCK: tl.constexpr):
+        offs = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        valid = offs < n
+        m = tl.load(mask_ptr + offs, mask=valid, other=0) != 0
+        # Masked-off samples neither load x nor evaluate exp.
+        x = tl.load(x_ptr + offs, mask=valid & m, other=0.).to(tl.float32)
+        y = tl.where(m, tl.exp(x + shift), 0.)
+        tl.store(out_ptr + offs, y, mask=valid)
+
+
+def masked_exp(x: torch.Tensor, selector: torch.Tensor, shift: float = 0.):
+    """exp(x + shift) * selector[..., None] for x of shape [..., 1]"""
+    assert x.shape[-1] == 1 and x.numel() == selector.numel()
+    x_flat = x.contiguous().view(-1)
+    mask = selector.contiguous().view(-1).view(torch.uint8)
+    out = torch.empty_like(x_flat)
+    n = x_flat.numel()
+    if n > 0:
+        grid = (triton.cdiv(n, _BLOCK),)
+        _masked_exp_kernel[grid](x_flat, mask, out, n, shift, BLOCK=_BLOCK)
+    return out.view(x.shape)
+
+
+if HAS_TRITON:
+    @triton.jit
+    def _normalize_kernel(x_ptr, out_ptr, sel_ptr, n_rows,
+                          MIN0: tl.constexpr, MIN1: tl.constexpr, MIN2: tl.constexpr,
+                          INV0: tl.constexpr, INV1: tl.constexpr, INV2: tl.constexpr,
+                          BLOCK: tl.constexpr):
+        # The aabb is baked into the kernel, one specialization per scene bound.
+        rows = tl.program_id(0) * BLOCK + tl.arange(0, BLOCK)
+        valid = rows < n_rows
+        offs = rows * 3
+
+        y0 = (tl.load(x_ptr + offs + 0, mask=valid, other=0.).to(tl.float32) - MIN0) * INV0
+        y1 = (tl.load(x_ptr + offs + 1, mask=valid, other=0.).to(tl.float32) - MIN1) * INV1
+        y2 = (tl.load(x_ptr + offs + 2, mask=valid, other=0.).to(tl.float32) - MIN2) * INV2
+        inside = (y0 > 0.) & (y0 < 1.) & (y1 > 0.) & (y1 < 1.) & (y2 > 0.) & (y2 < 1.)
+
+        tl.store(out_ptr + offs + 0, y0, mask=valid)
+        tl.store(out_ptr + offs + 1, y1, mask=valid)
+        tl.store(out_ptr + offs + 2, y2, mask=valid)
+        tl.store(sel_ptr + rows, inside.to(tl.uint8), mask=valid)
+
+
+def normalize_aabb_fused(x: torch.Tensor, aabb_min: tuple, inv_extent: tuple):
+    """
+    (x - aabb_min) * inv_extent and its inside-[0, 1]^3 selector in one pass.
+    aabb_min and inv_extent are python floats so they become kernel constants.
+    """
+    assert x.shape[-1] == 3
+    x_flat = x.reshape(-1, 3).contiguous()
+    out = torch.empty(x_flat.shape, dtype=torch.promote_types(x.dtype, torch.float32), device=x.device)
+    selector = torch.empty(x_flat.shape[0], dtype=torch.bool, device=x.device)
+    n_rows = x_flat.shape[0]
+    if n_rows > 0:
+        grid = (triton.cdiv(n_rows, _BLOCK),)
+        _normalize_kernel[grid](x_flat, out, selector.view(torch.uint8), n_rows,
+                                *aabb_min, *inv_extent, BLOCK=_BLOCK)
+    return out.view(x.shape), selector.view(x.shape[:-1])
+
+
+def contract_to_unisphere_fused(
+    x: torch.Tensor,
+    aabb: torch.Tensor,
+    eps: float = 1e-6,
+    derivative: bool = False,
+):
+    assert x.shape[-1] == 3 and aabb.numel() == 6
+    x_flat = x.reshape(-1, 3).contiguous()
+    aabb = aabb.to(device=x.device).contiguous()
+    out = torch.empty(x_flat.shape, dtype=torch.promote_types(x.dtype, aabb.dtype), device=x.device)
+    n_rows = x_flat.shape[0]
+    if n_rows > 0:
+        grid = (triton.cdiv(n_rows, _BLOCK),)
+        _contract_kernel[grid](x_flat, aabb, out, n_rows, eps,
+                               DERIVATIVE=derivative, BLOCK=_BLOCK)
+    return out.view(x.shape)
+
+
+if HAS_NUMBA:
+    @numba.njit(parallel=True, fastmath=True, cache=True)
+    def _contract_numba(x, aabb, out, eps, derivative):
+        for i in numba.prange(x.shape[0]):
+            # aabb is at [-1, 1]
+            y0 = (x[i, 0] - aabb[0]) / (aabb[3] - aabb[0]) * 2. - 1.
+            y1 = (x[i, 1] - aabb[1]) / (aabb[4] - aabb[1]) * 2. - 1.
+            y2 = (x[i, 2] - aabb[2]) / (aabb[5] - aabb[2]) * 2. - 1.
+            # inv == 1 inside the unit ball, where both outputs are the identity.
+            inv = 1. / np.sqrt(max(y0 * y0 + y1 * y1 + y2 * y2, 1.))
+            # (2 - 1 / mag) / mag, shared by both branches
+            s = (2. - inv) * inv
+            if derivative:
+                b = 2. * (inv - 1.) * inv * inv * inv
+                out[i, 0] = max(s + y0 * y0 * b, eps)
+                out[i, 1] = max(s + y1 * y1 * b, eps)
+                out[i, 2] = max(s + y2 * y2 * b, eps)
+            else:
+                # [-inf, inf] is at [0, 1]
+                out[i, 0] = y0 * s / 4. + .5
+                out[i, 1] = y1 * s / 4. + .5
+                out[i, 2] = y2 * s / 4. + .5
+
+
+def contract_to_unisphere_numba(
+    x: torch.Tensor,
+    aabb: torch.Tensor,
+    eps: float = 1e-6,
+    derivative: bool = False,
+):
+    assert x.shape[-1] == 3 and aabb.numel() == 6
+    dtype = torch.promote_types(x.dtype, aabb.dtype)
+    x_np = x.detach().reshape(-1, 3).to(dtype).contiguous().numpy()
+    aabb_np = aabb.detach().reshape(-1).to(dtype).contiguous().numpy()
+    out = np.empty_like(x_np)
+    _contract_numba(x_np, aabb_np, out, eps, derivative)
+    return torch.from_numpy(out).view(x.shape)
@@ -2,13 +2,20 @@
 Copyright (c) 2022 Ruilong Li, UC Berkeley.
 """
 
-from typing import Callable, List, Union
+from typing import List, Union
 
 import numpy as np
 import torch
-from torch.autograd import Function
-from torch.cuda.amp import custom_bwd, custom_fwd
 
+from modules.fields.fused_ops import (
+    HAS_TRITON,
+    can_fuse,
+    can_fuse_cpu,
+    contract_to_unisphere_fused,
+    contract_to_unisphere_numba,
+    masked_exp,
+    normalize_aabb_fused,
+)
 
 try:
     import tinycudann as tcnn
@@ -21,23 +28,157 @@ except ImportError as e:
     exit()
 
 
-class _TruncExp(Function):  # pylint: disable=abstract-method
-    # Implementation from torch-ngp:
+def _trunc_exp_inference(x):
+    # No autograd bookkeeping when no gradient is needed.
+    return torch.exp(x)
+
+
+def _trunc_exp_training(x):
+    # exp with its gradient truncated at x = 15, as in torch-ngp:
     # https://github.com/ashawkey/torch-ngp/blob/93b08a0d4ec1cc6e69d85df7f0acdfb99603b628/activation.py
-    @staticmethod
-    @custom_fwd(cast_inputs=torch.float32)
-    def forward(ctx, x):  # pylint: disable=arguments-differ
-        ctx.save_for_backward(x)
-        return torch.exp(x)
+    # A straight-through clamp instead of an autograd.Function, so that
+    # torch.compile can trace (and fuse) it.
+    x_clamped = x - (x - 15.).clamp(min=0.).detach()
+    exp_clamped = torch.exp(x_clamped)
+    return exp_clamped + (torch.exp(x) - exp_clamped).detach()
+
+
+def trunc_exp(x):
+    if torch.is_grad_enabled() and x.requires_grad:
+        return _trunc_exp_training(x)
+    return _trunc_exp_inference(x)
+
+
+def _activate_and_mask(x, selector, shift):
+    return trunc_exp(x + shift) * selector[..., None]
+
+
+def _compile_supported():
+    # torch.compile needs Triton for the generated kernels and a Python /
+    # platform Dynamo runs on (torch 2.0 supports neither 3.11 nor Windows).
+    if not (HAS_TRITON and hasattr(torch, "compile")):
+        return False
+    from torch._dynamo.eval_frame import check_if_dynamo_supported
+    try:
+        check_if_dynamo_supported()
+    except RuntimeError:
+        return False
+    return True
+
+
+# Let Inductor fuse the activation with the selector multiply when training.
+# The number of samples changes every step, hence dynamic shapes instead of
+# the CUDA graphs of mode="reduce-overhead". Compiled on first use, so that
+# importing this module does not depend on Dynamo.
+_activate_and_mask_compiled = None
+
+
+def _activate_and_mask_training(x, selector, shift):
+    global _activate_and_mask_compiled
+    if _activate_and_mask_compiled is None:
+        _activate_and_mask_compiled = (
+            torch.compile(_activate_and_mask, dynamic=True)
+            if _compile_supported() else _activate_and_mask
+        )
+    return _activate_and_mask_compiled(x, selector, shift)
+
 
-    @staticmethod
-    @custom_bwd
-    def backward(ctx, g):  # pylint: disable=arguments-differ
-        x = ctx.saved_tensors[0]
-        return g * torch.exp(torch.clamp(x, max=15))
+def activate_density(x, selector, shift=0.):
+    """trunc_exp(x + shift) * selector[..., None]"""
+    if can_fuse(x):
+        return masked_exp(x, selector, shift)
+    if torch.is_grad_enabled() and x.requires_grad:
+        return _activate_and_mask_training(x, selector, shift)
+    return _activate_and_mask(x, selector, shift)
+
+
+def _part1by2(v):
+    # Spread the lower 10 bits of v so that there are two zero bits between each.
+    v = v & 0x3ff
+    v = (v | (v << 16)) & 0x030000ff
+    v = (v | (v << 8)) & 0x0300f00f
+    v = (v | (v << 4)) & 0x030c30c3
+    v = (v | (v << 2)) & 0x09249249
+    return v
+
+
+def morton_code(x: torch.Tensor, bits: int = 10):
+    """30-bit Morton (z-order) code of points in [0, 1]^3, shape [N, 3] -> [N]"""
+    q = (x * (1 << bits)).long().clamp_(0, (1 << bits) - 1)
+    return _part1by2(q[:, 0]) | (_part1by2(q[:, 1]) << 1) | (_part1by2(q[:, 2]) << 2)
+
+
+class _CUDAGraphCache:
+    """Replays CUDA graphs of a static, sync-free forward, one per input shape."""
+
+    def __init__(self, fn, max_graphs: int = 8, warmup_iters: int = 3):
+        self.fn = fn
+        self.max_graphs = max_graphs
+        self.warmup_iters = warmup_iters
+        self.graphs = dict()
+        self.pool = None
+
+    def reset(self):
+        self.graphs = dict()
+        self.pool = None
+
+    def _capture(self, x):
+        static_in = x.clone()
+        stream = torch.cuda.Stream(device=x.device)
+        stream.wait_stream(torch.cuda.current_stream(x.device))
+        with torch.cuda.stream(stream):
+            for _ in range(self.warmup_iters):
+                self.fn(static_in)
+        torch.cuda.current_stream(x.device).wait_stream(stream)
+
+        graph = torch.cuda.CUDAGraph()
+        with torch.cuda.graph(graph, pool=self.pool, stream=stream):
+            static_out = self.fn(static_in)
+        if self.pool is None:
+            self.pool = graph.pool()
+        return graph, static_in, static_out
+
+    def __call__(self, x):
+        key = (tuple(x.shape), x.dtype, x.device)
+        entry = self.graphs.get(key)
+        if entry is None:
+            if len(self.graphs) >= self.max_graphs:
+                return self.fn(x)
+            entry = self._capture(x)
+            self.graphs[key] = entry
+        graph, static_in, static_out = entry
+        static_in.copy_(x)
+        graph.replay()
+        if isinstance(static_out, tuple):
+            return tuple(out.clone() for out in static_out)
+        return static_out.clone()
+
+
+def _set_derived_buffer(module, name, value):
+    # In place once registered, so that existing references to the buffer
+    # stay valid.
+    if name in module._buffers:
+        module._buffers[name].copy_(value)
+    else:
+        module.register_buffer(name, value, persistent=False)
 
 
-trunc_exp = _TruncExp.apply
+def _set_aabb_derived(field):
+    """
+    Cache what the normalization needs from field.aabb. The buffers are
+    non-persistent so existing checkpoints still load; call again whenever
+    aabb changes.
+    """
+    aabb_min, aabb_max = torch.split(field.aabb, field.num_dim, dim=-1)
+    inv_extent = 1.0 / (aabb_max - aabb_min)
+    _set_derived_buffer(field, "aabb_inv_extent", inv_extent)
+    # (x - aabb_min) * inv_extent == aabb_offset + x * inv_extent, a single addcmul.
+    _set_derived_buffer(field, "aabb_offset", -aabb_min * inv_extent)
+    # Static scene bounds, specialized into the fused normalization kernel.
+    field._aabb_consts = (
+        (tuple(aabb_min.tolist()), tuple(inv_extent.tolist()))
+        if field.num_dim == 3 else None
+    )
 
 
 def contract_to_unisphere(
@@ -46,25 +187,40 @@ def contract_to_unisphere(
     eps: float = 1e-6,
     derivative: bool = False,
 ):
+    if can_fuse(x):
+        return contract_to_unisphere_fused(x, aabb, eps=eps, derivative=derivative)
+    if can_fuse_cpu(x):
+        return contract_to_unisphere_numba(x, aabb, eps=eps, derivative=derivative)
+
     aabb_min, aabb_max = torch.split(aabb, 3, dim=-1)
     x = (x - aabb_min) / (aabb_max - aabb_min)
     x = x * 2 - 1  # aabb is at [-1, 1]
-    mag = x.norm(dim=-1, keepdim=True)
-    mask = mag.squeeze(-1) > 1
+    # Clamping at 1 makes inv_mag == 1 inside the unit ball, where both the
+    # contraction and its derivative reduce to the identity; no mask needed.
+    inv_mag = torch.rsqrt((x * x).sum(dim=-1, keepdim=True).clamp(min=1.0))
+    scale = (2 - inv_mag) * inv_mag  # (2 - 1 / mag) / mag
 
     if derivative:
-        dev = (2 * mag - 1) / mag**2 + 2 * x**2 * (
-            1 / mag**3 - (2 * mag - 1) / mag**4
-        )
-        dev[~mask] = 1.0
+        dev = scale + 2 * x * x * (inv_mag - 1) * (inv_mag * inv_mag * inv_mag)
         dev = torch.clamp(dev, min=eps)
         return dev
     else:
-        x[mask] = (2 - 1 / mag[mask]) * (x[mask] / mag[mask])
+        x = scale * x
         x = x / 4 + 0.5  # [-inf, inf] is at [0, 1]
         return x
 
 
+class _EncodedHead:
+    """head(encoding(x)) as a plain callable, so that neither is registered twice"""
+
+    def __init__(self, encoding, head):
+        self.encoding = encoding
+        self.head = head
+
+    def __call__(self, x):
+        return self.head(self.encoding(x))
+
+
 class NGPNeRF(torch.nn.Module):
     """Instance-NGP radiance Field"""
 
@@ -73,94 +229,196 @@ class NGPNeRF(torch.nn.Module):
         aabb: Union[torch.Tensor, List[float]],
         num_dim: int = 3,
         use_viewdirs: bool = False,
-        density_activation: Callable = lambda x: trunc_exp(x),
+        density_shift: float = 0.,
         unbounded: bool = False,
         geo_feat_dim: int = 31,
         n_levels: int = 16,
         log2_hashmap_size: int = 19,
         out_feat_dim: int = 3,
+        reuse_buffers: bool = False,
+        use_cuda_graph: bool = False,
+        spatial_sort: bool = False,
+        spatial_sort_min_batch: int = 65536,
+        concurrent_heads: bool = False,
+        shared_encoding: bool = False,
+        empty_check_interval: int = 16,
     ) -> None:
         super().__init__()
         if not isinstance(aabb, torch.Tensor):
             aabb = torch.tensor(aabb, dtype=torch.float32)
         self.register_buffer("aabb", aabb)
         self.num_dim = num_dim
+        _set_aabb_derived(self)
         self.use_viewdirs = use_viewdirs
-        self.density_activation = density_activation
+        self.density_shift = density_shift  # density is trunc_exp(x + density_shift)
         self.unbounded = unbounded
+        # Without grad, forward() writes into grow-only output buffers; its
+        # result is then only valid until the next call.
+        self.reuse_buffers = reuse_buffers
+        self._out_bufs = None
+        # Eval-only; meant for ray marching with a fixed number of samples.
+        self.use_cuda_graph = use_cuda_graph
+        self._cuda_graphs = _CUDAGraphCache(self._forward_dense)
+        # Feed large batches to the hash grids in Morton order for cache locality.
+        self.spatial_sort = spatial_sort and num_dim == 3
+        self.spatial_sort_min_batch = spatial_sort_min_batch
+        # Run geo_mlp and app_mlp of forward() on two side streams. The small
+        # MLPs underuse the SMs on their own. Streams are created lazily.
+        self.concurrent_heads = concurrent_heads
+        self._head_streams = None
+        # No-grad queries test for all-background batches (a host sync) only
+        # every empty_check_interval calls, and on every call while such
+        # batches keep coming.
+        self.empty_check_interval = empty_check_interval
+        self._calls_since_empty_check = 0
+        self._last_batch_empty = False
 
         self.geo_feat_dim = geo_feat_dim
         self.out_feat_dim = out_feat_dim
         per_level_scale = 1.4472692012786865
 
-        self.geo_mlp = tcnn.NetworkWithInputEncoding(
-            n_input_dims=num_dim,
-            n_output_dims=1,
-            encoding_config={
-                "otype": "HashGrid",
-                "n_levels": n_levels,
-                "n_features_per_level": 2,
-                "log2_hashmap_size": 18,
-                "base_resolution": 16,
-                "per_level_scale": per_level_scale,
-            },
-            network_config={
-                "otype": "FullyFusedMLP",
-                "activation": "ReLU",
-                "output_activation": "None",
-                "n_neurons": 64,
-                "n_hidden_layers": 1,
-            },
-        )
+        # tcnn picks the parameter / output precision itself (FP16 wherever the
+        # GPU supports it), there is no config key for it. Outputs therefore come
+        # back in FP16 and are only upcast right before the density activation.
+        encoding_config = {
+            "otype": "HashGrid",
+            "n_levels": n_levels,
+            "n_features_per_level": 2,
+            "log2_hashmap_size": 18,
+            "base_resolution": 16,
+            "per_level_scale": per_level_scale,
+        }
+        geo_network_config = {
+            "otype": "FullyFusedMLP",
+            "activation": "ReLU",
+            "output_activation": "None",
+            "n_neurons": 64,
+            "n_hidden_layers": 1,
+        }
+        app_network_config = {
+            "otype": "FullyFusedMLP",
+            "activation": "ReLU",
+            "output_activation": "Sigmoid",
+            "n_neurons": 64,
+            "n_hidden_layers": 2,
+        }
 
-        self.app_mlp = tcnn.NetworkWithInputEncoding(
-            n_input_dims=num_dim,
-            n_output_dims=3,
-            encoding_config={
-                "otype": "HashGrid",
-                "n_levels": n_levels,
-                "n_features_per_level": 2,
-                "log2_hashmap_size": 18,
-                "base_resolution": 16,
-                "per_level_scale": per_level_scale,
-            },
-            network_config={
-                "otype": "FullyFusedMLP",
-                "activation": "ReLU",
-                "output_activation": "Sigmoid",
-                "n_neurons": 64,
-                "n_hidden_layers": 2,
-            },
-        )
+        # One hash table feeding both heads halves the encoding work and memory.
+        # geo_parameters() / app_parameters() both include it, so the geo and
+        # app training stages then both update the shared table.
+        self.shared_encoding = shared_encoding
+        if shared_encoding:
+            self.encoding = tcnn.Encoding(
+                n_input_dims=num_dim,
+                encoding_config=encoding_config,
+            )
+            self.geo_net = tcnn.Network(
+                n_input_dims=self.encoding.n_output_dims,
+                n_output_dims=1,
+                network_config=geo_network_config,
+            )
+            self.app_net = tcnn.Network(
+                n_input_dims=self.encoding.n_output_dims,
+                n_output_dims=3,
+                network_config=app_network_config,
+            )
+            # Plain callables rather than submodules, so that state_dict holds
+            # the shared table only once.
+            self.geo_mlp = _EncodedHead(self.encoding, self.geo_net)
+            self.app_mlp = _EncodedHead(self.encoding, self.app_net)
+        else:
+            self.geo_mlp = tcnn.NetworkWithInputEncoding(
+                n_input_dims=num_dim,
+                n_output_dims=1,
+                encoding_config=encoding_config,
+                network_config=geo_network_config,
+            )
+            self.app_mlp = tcnn.NetworkWithInputEncoding(
+                n_input_dims=num_dim,
+                n_output_dims=3,
+                encoding_config=encoding_config,
+                network_config=app_network_config,
+            )
 
-    def query_density(self, x):
-        aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
-        x = (x - aabb_min) / (aabb_max - aabb_min)
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # The loaded aabb may differ from the one given at construction.
+        _set_aabb_derived(self)
+        # Captured graphs have the old bounds baked into the fused kernels.
+        self._cuda_graphs.reset()
 
+    def _normalize(self, x):
+        if self._aabb_consts is not None and can_fuse(x):
+            return normalize_aabb_fused(x, *self._aabb_consts)
+        x = torch.addcmul(self.aabb_offset, x, self.aabb_inv_extent)
         selector = ((x > 0.0) & (x < 1.0)).all(dim=-1)
-        x = (
-            self.geo_mlp(x.view(-1, self.num_dim))
-            .view(list(x.shape[:-1]) + [1])
-            .to(x)
-        )
-        density = (
-            self.density_activation(x)
-            * selector[..., None]
-        )
-        return density
+        return x, selector
 
-    def query_rgb(self, x):
-        aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
-        x = (x - aabb_min) / (aabb_max - aabb_min)
+    def _should_sort(self, n_samples):
+        return self.spatial_sort and n_samples > self.spatial_sort_min_batch
 
-        selector = ((x > 0.0) & (x < 1.0)).all(dim=-1)
-        rgb = (
-            self.app_mlp(x.view(-1, self.num_dim))
-            .view(list(x.shape[:-1]) + [3])
-        )
+    def _run_mlp(self, mlp, x_flat):
+        if not self._should_sort(x_flat.shape[0]):
+            return mlp(x_flat)
+        perm = morton_code(x_flat).argsort()
+        out_sorted = mlp(x_flat[perm])
+        return out_sorted.new_empty(out_sorted.shape).index_put_((perm,), out_sorted)
+
+    def _density_from_normalized(self, x, selector):
+        mlp_out = self._run_mlp(self.geo_mlp, x.view(-1, self.num_dim))
+        return self._finish_density(mlp_out, x, selector)
+
+    def _rgb_from_normalized(self, x, selector):
+        mlp_out = self._run_mlp(self.app_mlp, x.view(-1, self.num_dim))
+        return self._finish_rgb(mlp_out, x, selector)
+
+    def _finish_density(self, mlp_out, x, selector):
+        # tcnn ignores autocast and returns FP16 wherever the GPU supports it,
+        # so upcast here for the density activation to see FP32.
+        if mlp_out.dtype != x.dtype:
+            mlp_out = mlp_out.to(x.dtype)
+        x = mlp_out.view(*x.shape[:-1], 1)
+        density = activate_density(x, selector, self.density_shift)
+        return density
+
+    def _finish_rgb(self, mlp_out, x, selector):
+        rgb = mlp_out.view(*x.shape[:-1], 3)
         rgb = rgb * selector[..., None]
         return rgb
 
+    @property
+    def _rgb_dtype(self):
+        # Output dtype of the colour head (tcnn's parameter precision).
+        return (self.app_net if self.shared_encoding else self.app_mlp).dtype
+
+    def _nothing_inside(self, selector):
+        # Batches of pure background samples are common during sampling. Without
+        # grad there is no graph to keep alive, so the MLPs can be skipped for
+        # them; the check is amortized since it syncs with the host.
+        if torch.is_grad_enabled():
+            return False
+        self._calls_since_empty_check += 1
+        if (
+            not self._last_batch_empty
+            and self._calls_since_empty_check < self.empty_check_interval
+        ):
+            return False
+        self._calls_since_empty_check = 0
+        self._last_batch_empty = not bool(selector.any())
+        return self._last_batch_empty
+
+    def query_density(self, x):
+        x, selector = self._normalize(x)
+        if self._nothing_inside(selector):
+            return x.new_zeros(*x.shape[:-1], 1)
+        return self._density_from_normalized(x, selector)
+
+    def query_rgb(self, x):
+        x, selector = self._normalize(x)
+        if self._nothing_inside(selector):
+            return x.new_zeros(*x.shape[:-1], 3, dtype=self._rgb_dtype)
+        return self._rgb_from_normalized(x, selector)
+
     def forward(
         self,
         positions: torch.Tensor,
@@ -171,30 +429,137 @@ class NGPNeRF(torch.nn.Module):
             assert (
                 positions.shape == directions.shape
             ), f"{positions.shape} v.s. {directions.shape}"
-        density = self.query_density(positions)
-        rgb = self.query_rgb(positions)
+        if (
+            self.use_cuda_graph
+            and not self.training
+            and not torch.is_grad_enabled()
+            and positions.is_cuda
+        ):
+            return self._cuda_graphs(positions)
+        # Both heads consume the same normalized coordinates and selector.
+        x, selector = self._normalize(positions)
+        x_flat = x.reshape(-1, self.num_dim)
+        # Compact the in-bounds samples so that the MLPs skip the rest.
+        idx = selector.reshape(-1).nonzero(as_tuple=True)[0]
+        if idx.numel() == 0:
+            if not torch.is_grad_enabled():
+                return (
+                    x.new_zeros(*x.shape[:-1], 3, dtype=self._rgb_dtype),
+                    x.new_zeros(*x.shape[:-1], 1),
+                )
+            # Never hand tcnn an empty batch; the dense path keeps the graph.
+            return self._dense_from_normalized(x, selector)
+        x_valid = x_flat[idx]
+        if self._should_sort(x_valid.shape[0]):
+            # Sorting idx itself makes the scatter below undo the permutation.
+            perm = morton_code(x_valid).argsort()
+            idx = idx[perm]
+            x_valid = x_valid[perm]
+        geo_out, app_out = self._run_heads(x_valid, concurrent=self.concurrent_heads)
+
+        n_samples = x_flat.shape[0]
+        density_valid = trunc_exp(geo_out.to(x) + self.density_shift)
+        if self.reuse_buffers and not torch.is_grad_enabled():
+            density, rgb = self._output_buffers(n_samples, x.dtype, app_out.dtype, x.device)
+            # Only the masked-off rows have to be re-zeroed.
+            invalid = ~selector.reshape(-1, 1)
+            density.index_put_((idx,), density_valid).masked_fill_(invalid, 0.)
+            rgb.index_put_((idx,), app_out).masked_fill_(invalid, 0.)
+        else:
+            density = x.new_zeros(n_samples, 1).index_put_((idx,), density_valid)
+            rgb = app_out.new_zeros(n_samples, 3).index_put_((idx,), app_out)
+        density = density.view(*x.shape[:-1], 1)
+        rgb = rgb.view(*x.shape[:-1], 3)
+        return rgb, density
+
+    def _run_heads(self, x, concurrent=False):
+        if self.shared_encoding:
+            x = self.encoding(x)
+            geo_mlp, app_mlp = self.geo_net, self.app_net
+        else:
+            geo_mlp, app_mlp = self.geo_mlp, self.app_mlp
+
+        if not (concurrent and x.is_cuda):
+            return geo_mlp(x), app_mlp(x)
+
+        if self._head_streams is None:
+            self._head_streams = (
+                torch.cuda.Stream(device=x.device),
+                torch.cuda.Stream(device=x.device),
+            )
+        geo_stream, app_stream = self._head_streams
+        current = torch.cuda.current_stream(x.device)
+        geo_stream.wait_stream(current)
+        app_stream.wait_stream(current)
+        with torch.cuda.stream(geo_stream):
+            geo_out = geo_mlp(x)
+        with torch.cuda.stream(app_stream):
+            app_out = app_mlp(x)
+        current.wait_stream(geo_stream)
+        current.wait_stream(app_stream)
+        # Keep the allocator from recycling these blocks while another stream
+        # may still be using them.
+        x.record_stream(geo_stream)
+        x.record_stream(app_stream)
+        geo_out.record_stream(current)
+        app_out.record_stream(current)
+        return geo_out, app_out
+
+    def _forward_dense(self, positions):
+        # Same result as forward() but without the (syncing) compaction, so
+        # that it can be captured into a CUDA graph. The side streams and
+        # record_stream of concurrent_heads are not capture-safe, so this path
+        # always runs the heads on the current stream.
+        x, selector = self._normalize(positions)
+        return self._dense_from_normalized(x, selector)
+
+    def _dense_from_normalized(self, x, selector):
+        geo_out, app_out = self._run_heads(x.view(-1, self.num_dim), concurrent=False)
+        density = self._finish_density(geo_out, x, selector)
+        rgb = self._finish_rgb(app_out, x, selector)
         return rgb, density
 
+    def _output_buffers(self, n_samples, density_dtype, rgb_dtype, device):
+        # Sample counts change from batch to batch during ray marching, so keep
+        # one buffer pair that only grows instead of one pair per count.
+        bufs = self._out_bufs
+        if (
+            bufs is None
+            or bufs[0].shape[0] < n_samples
+            or bufs[0].dtype != density_dtype
+            or bufs[1].dtype != rgb_dtype
+            or bufs[0].device != device
+        ):
+            bufs = (
+                torch.empty(n_samples, 1, dtype=density_dtype, device=device),
+                torch.empty(n_samples, 3, dtype=rgb_dtype, device=device),
+            )
+            self._out_bufs = bufs
+        return bufs[0][:n_samples], bufs[1][:n_samples]
+
+    def geo_parameters(self):
+        """Parameters of geo_mlp, including a shared encoding."""
+        if self.shared_encoding:
+            return [*self.encoding.parameters(), *self.geo_net.parameters()]
+        return list(self.geo_mlp.parameters())
+
+    def app_parameters(self):
+        """Parameters of app_mlp, including a shared encoding."""
+        if self.shared_encoding:
+            return [*self.encoding.parameters(), *self.app_net.parameters()]
+        return list(self.app_mlp.parameters())
+
+    @torch.no_grad()
     def reset_geo(self):
-        self.geo_mlp = tcnn.NetworkWithInputEncoding(
-            n_input_dims=3,
-            n_output_dims=1,
-            encoding_config={
-                "otype": "HashGrid",
-                "n_levels": 16,
-                "n_features_per_level": 2,
-                "log2_hashmap_size": 18,
-                "base_resolution": 16,
-                "per_level_scale": 1.4472692012786865,
-            },
-            network_config={
-                "otype": "FullyFusedMLP",
-                "activation": "ReLU",
-                "output_activation": "None",
-                "n_neurons": 64,
-                "n_hidden_layers": 1,
-            },
-        )
+        """
+        Re-initialize geo_mlp in place with tcnn's own initializer, which gives
+        the same parameters as a freshly constructed module. Parameter tensors
+        (and therefore optimizer references and captured CUDA graphs) stay valid.
+        """
+        # With a shared encoding only the density head is reset, the hash
+        # table is still needed by app_mlp.
+        geo_mlp = self.geo_net if self.shared_encoding else self.geo_mlp
+        geo_mlp.params.copy_(geo_mlp.native_tcnn_module.initial_params(geo_mlp.seed))
 
 
 class NGPDensityField(torch.nn.Module):
@@ -204,24 +569,28 @@ class NGPDensityField(torch.nn.Module):
         self,
         aabb: Union[torch.Tensor, List[float]],
         num_dim: int = 3,
-        density_activation: Callable = lambda x: trunc_exp(x - 1),
+        density_shift: float = -1.,
         unbounded: bool = False,
         base_resolution: int = 16,
         max_resolution: int = 128,
         n_levels: int = 5,
         log2_hashmap_size: int = 17,
+        use_cuda_graph: bool = False,
     ) -> None:
         super().__init__()
         if not isinstance(aabb, torch.Tensor):
             aabb = torch.tensor(aabb, dtype=torch.float32)
         self.register_buffer("aabb", aabb)
         self.num_dim = num_dim
-        self.density_activation = density_activation
+        _set_aabb_derived(self)
+        self.density_shift = density_shift  # density is trunc_exp(x + density_shift)
         self.unbounded = unbounded
         self.base_resolution = base_resolution
         self.max_resolution = max_resolution
         self.n_levels = n_levels
         self.log2_hashmap_size = log2_hashmap_size
+        self.use_cuda_graph = use_cuda_graph
+        self._cuda_graphs = _CUDAGraphCache(self._forward_impl)
 
         per_level_scale = np.exp(
             (np.log(max_resolution) - np.log(base_resolution)) / (n_levels - 1)
@@ -247,20 +616,37 @@ class NGPDensityField(torch.nn.Module):
             },
         )
 
+    def _load_from_state_dict(self, state_dict, prefix, *args, **kwargs):
+        super()._load_from_state_dict(state_dict, prefix, *args, **kwargs)
+        # The loaded aabb may differ from the one given at construction.
+        _set_aabb_derived(self)
+        # Captured graphs have the old bounds baked into the fused kernels.
+        self._cuda_graphs.reset()
+
     def forward(self, positions: torch.Tensor):
+        if (
+            self.use_cuda_graph
+            and not self.training
+            and not torch.is_grad_enabled()
+            and positions.is_cuda
+        ):
+            return self._cuda_graphs(positions)
+        return self._forward_impl(positions)
+
+    def _forward_impl(self, positions: torch.Tensor):
         if self.unbounded:
             positions = contract_to_unisphere(positions, self.aabb)
+            selector = ((positions > 0.0) & (positions < 1.0)).all(dim=-1)
+        elif self._aabb_consts is not None and can_fuse(positions):
+            positions, selector = normalize_aabb_fused(positions, *self._aabb_consts)
         else:
-            aabb_min, aabb_max = torch.split(self.aabb, self.num_dim, dim=-1)
-            positions = (positions - aabb_min) / (aabb_max - aabb_min)
-        selector = ((positions > 0.0) & (positions < 1.0)).all(dim=-1)
-        density_before_activation = (
-            self.mlp_base(positions.view(-1, self.num_dim))
-            .view(list(positions.shape[:-1]) + [1])
-            .to(positions)
-        )
-        density = (
-            self.density_activation(density_before_activation)
-            * selector[..., None]
+            positions = torch.addcmul(self.aabb_offset, positions, self.aabb_inv_extent)
+            selector = ((positions > 0.0) & (positions < 1.0)).all(dim=-1)
+        mlp_out = self.mlp_base(positions.view(-1, self.num_dim))
+        if mlp_out.dtype != positions.dtype:
+            mlp_out = mlp_out.to(positions.dtype)
+        density_before_activation = mlp_out.view(*positions.shape[:-1], 1)
+        density = activate_density(
+            density_before_activation, selector, self.density_shift
         )
         return density
\ No newline at end of file
@@ -168,7 +168,7 @@ class NeRFScene(Scene):
                 )
 
         self.nerf.reset_geo() #  = NGPNeRF(aabb=self.aabb)
-        geo_optimizer = torch.optim.Adam(self.nerf.geo_mlp.parameters(), lr=self.train_conf.geo_optimizer.init_lr)
+        geo_optimizer = torch.optim.Adam(self.nerf.geo_parameters(), lr=self.train_conf.geo_optimizer.init_lr)
 
         for iter_i in tqdm(range(geo_res_iters)):
             self.update_lr(geo_optimizer, self.train_conf.geo_optimizer, iter_i / geo_res_iters)
@@ -177,7 +177,7 @@ class NeRFScene(Scene):
 
             self.train_one_step_geo(geo_optimizer, sup_pool, pixel_sup_rand_mode, progress=iter_i / app_res_iters, grad_scaler=grad_scaler)
 
-        app_optimizer = torch.optim.Adam(self.nerf.app_mlp.parameters(), lr=self.train_conf.app_optimizer.init_lr)
+        app_optimizer = torch.optim.Adam(self.nerf.app_parameters(), lr=self.train_conf.app_optimizer.init_lr)
 
         for iter_i in tqdm(range(app_res_iters)):
             self.update_lr(app_optimizer, self.train_conf.app_optimizer, iter_i / app_res_iters)